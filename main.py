@@ -1,12 +1,24 @@
+import asyncio
+import hashlib
+import itertools
+import logging
 import os
+import queue
 import re
 import sqlite3
+import threading
 import time
-from typing import List, Dict, Tuple, Optional
-
-import requests
-from telegram import Update
-from telegram.constants import ChatAction
+from contextlib import asynccontextmanager
+from collections import OrderedDict, defaultdict, deque
+from operator import itemgetter
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, DefaultDict, Deque, List, Dict, Tuple, Optional, TypeVar
+
+import httpx
+import orjson
+from telegram import Message, Update
+from telegram.constants import ChatAction, ChatType
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
 
 # =========================
@@ -20,9 +32,20 @@ LLM_BASE_URL = os.getenv("LLM_BASE_URL", "").strip()  # e.g. https://api.yourpro
 LLM_API_KEY = os.getenv("LLM_API_KEY", "").strip()
 LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4.1-mini").strip()  # provider-specific model name
 LLM_TIMEOUT_SEC = int(os.getenv("LLM_TIMEOUT_SEC", "60"))
+# Max wait for the first reply chunk before the request is retried once.
+LLM_RETRY_TIMEOUT_SEC = int(os.getenv("LLM_RETRY_TIMEOUT_SEC", "20"))
+# Min seconds between progressive edits of a streamed reply (0 = send only the final text).
+LLM_STREAM_EDIT_SEC = float(os.getenv("LLM_STREAM_EDIT_SEC", "1.5"))
+LLM_STREAM_EDIT_SEC_GROUP = float(os.getenv("LLM_STREAM_EDIT_SEC_GROUP", "4"))  # same, for group chats
+# Send a prompt_cache_key hint: "auto" (only for api.openai.com), "1" or "0".
+LLM_PROMPT_CACHE = os.getenv("LLM_PROMPT_CACHE", "auto").strip().lower()
 
 DB_PATH = os.getenv("DB_PATH", "memory.sqlite")
 HISTORY_TURNS = int(os.getenv("HISTORY_TURNS", "14"))  # stored messages per chat (user+assistant)
+RECENT_PINS = 5  # pinned notes included in every prompt
+CACHE_CHATS = int(os.getenv("CACHE_CHATS", "1000"))  # chats whose context is kept in memory
+
+TG_RATE_PER_SEC = float(os.getenv("TG_RATE_PER_SEC", "28"))  # outbound Telegram calls per second
 
 if not TELEGRAM_BOT_TOKEN:
     raise RuntimeError("Missing TELEGRAM_BOT_TOKEN env var.")
@@ -31,99 +54,325 @@ if not LLM_BASE_URL:
 if not LLM_API_KEY:
     raise RuntimeError("Missing LLM_API_KEY env var.")
 
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
 
 # =========================
 # DB helpers
 # =========================
-def db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("PRAGMA journal_mode=WAL;")
+# Writes go through a single background thread that owns the write connection, so the
+# asyncio loop never blocks on an INSERT/fsync. Reads use a separate read-only
+# connection; WAL gives them a consistent snapshot while the writer commits.
+_WRITE_CONN: Optional[sqlite3.Connection] = None
+_READ_CONN: Optional[sqlite3.Connection] = None
+_WRITE_Q: "queue.Queue[Optional[Tuple[Tuple[str, tuple], ...]]]" = queue.Queue()
+# Calls enqueued (event-loop thread) vs. finished by the writer; readers wait on
+# _WRITE_DONE until everything enqueued before them is written.
+_WRITE_DONE = threading.Condition()
+_enqueued = 0
+_written = 0
+_WRITER: Optional[threading.Thread] = None
+_PINS_FTS = False  # set by init_db when the pins_fts index is available
+
+def _tune(conn: sqlite3.Connection) -> sqlite3.Connection:
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA cache_size=-30000;")  # ~30 MB page cache
+    conn.execute("PRAGMA mmap_size=134217728;")  # 128 MB
     return conn
 
+def db() -> sqlite3.Connection:
+    """Read-only connection used by the query helpers (opened in init_db)."""
+    assert _READ_CONN is not None, "init_db() must run first"
+    return _READ_CONN
+
+# Placeholder for "ts": the writer fills in one timestamp per drained batch.
+_NOW = object()
+
+def _write_batch(conn: sqlite3.Connection, stmts: List[Tuple[str, tuple]], now: int) -> None:
+    # Runs of the same statement go through executemany; order is preserved.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for sql, group in itertools.groupby(stmts, key=itemgetter(0)):
+            conn.executemany(sql, [
+                tuple(now if p is _NOW else p for p in params) for _sql, params in group
+            ])
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+def _writer_loop(conn: sqlite3.Connection) -> None:
+    global _written
+    while True:
+        # Drain everything queued meanwhile into one transaction: one WAL commit for all.
+        batch = [_WRITE_Q.get()]
+        while True:
+            try:
+                batch.append(_WRITE_Q.get_nowait())
+            except queue.Empty:
+                break
+        calls = [stmts for stmts in batch if stmts is not None]
+        now = int(time.time())
+        try:
+            try:
+                _write_batch(conn, [st for stmts in calls for st in stmts], now)
+            except Exception:
+                if len(calls) < 2:
+                    raise
+                # Don't let one bad call drop the rest of the batch.
+                for stmts in calls:
+                    try:
+                        _write_batch(conn, list(stmts), now)
+                    except Exception:
+                        log.exception("DB write failed")
+        except Exception:
+            log.exception("DB write failed")
+        finally:
+            with _WRITE_DONE:
+                _written += len(calls)
+                _WRITE_DONE.notify_all()
+        if len(calls) < len(batch):
+            return
+
+def _enqueue_write(*stmts: Tuple[str, tuple]) -> None:
+    # Statements of one call are committed together, in submission order.
+    global _enqueued
+    _enqueued += 1
+    _WRITE_Q.put(stmts)
+
+def _flush_writes() -> None:
+    # Blocks the calling thread until every write enqueued so far is committed, so a
+    # reader sees its own changes. Returns at once if the writer isn't running.
+    target = _enqueued
+    with _WRITE_DONE:
+        _WRITE_DONE.wait_for(lambda: _written >= target or _WRITER is None)
+
+async def wait_for_writes() -> None:
+    """_flush_writes for the event loop: waits in a worker thread, not on the loop."""
+    if _WRITER is not None and _written < _enqueued:
+        await asyncio.to_thread(_flush_writes)
+
+def close_db() -> None:
+    global _WRITE_CONN, _READ_CONN, _WRITER
+    if _WRITER is not None:
+        _WRITE_Q.put(None)
+        _WRITER.join()
+        with _WRITE_DONE:
+            _WRITER = None
+            _WRITE_DONE.notify_all()
+    if _READ_CONN is not None:
+        _READ_CONN.close()
+        _READ_CONN = None
+    if _WRITE_CONN is not None:
+        _WRITE_CONN.execute("PRAGMA optimize;")
+        _WRITE_CONN.close()
+        _WRITE_CONN = None
+
 def init_db() -> None:
-    with db() as conn:
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER NOT NULL,
-                role TEXT NOT NULL,            -- 'user' or 'assistant'
-                content TEXT NOT NULL,
-                ts INTEGER NOT NULL
-            );
-        """)
-        conn.execute("""
-            CREATE INDEX IF NOT EXISTS idx_messages_chat_ts
-            ON messages(chat_id, ts);
-        """)
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS pins (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER NOT NULL,
-                content TEXT NOT NULL,
-                ts INTEGER NOT NULL
-            );
-        """)
+    global _WRITE_CONN, _READ_CONN, _WRITER
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    # NORMAL is durable enough under WAL and avoids an fsync per insert.
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    _tune(conn)
+    # Each chat's history window is one JSON blob, rewritten per turn: a read is one
+    # row + one decode instead of HISTORY_TURNS row lookups.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS chat_state (
+            chat_id INTEGER PRIMARY KEY,
+            history BLOB NOT NULL,         -- JSON [{role, content}, ...], oldest first
+            ts INTEGER NOT NULL
+        );
+    """)
+    _migrate_messages(conn)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS pins (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            ts INTEGER NOT NULL
+        );
+    """)
+    # Covering index: recent-pins reads are index-only (id is the rowid). It replaces
+    # the old (chat_id, ts) index, which is a prefix of it.
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_pins_chat_ts_content
+        ON pins(chat_id, ts, content);
+    """)
+    conn.execute("DROP INDEX IF EXISTS idx_pins_chat_ts;")
+    _init_pins_fts(conn)
+    _WRITE_CONN = conn
+    _READ_CONN = _tune(sqlite3.connect(
+        Path(DB_PATH).resolve().as_uri() + "?mode=ro", uri=True, check_same_thread=False
+    ))
+    _WRITER = threading.Thread(target=_writer_loop, args=(conn,), name="db-writer", daemon=True)
+    _WRITER.start()
+
+def _migrate_messages(conn: sqlite3.Connection) -> None:
+    # One-off: fold the old per-row messages table into chat_state blobs.
+    if conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='messages'"
+    ).fetchone() is None:
+        return
+    chats: DefaultDict[int, List[Dict[str, str]]] = defaultdict(list)
+    last_ts: Dict[int, int] = {}
+    for chat_id, role, content, ts in conn.execute(
+        "SELECT chat_id, role, content, ts FROM messages ORDER BY chat_id, ts, id"
+    ):
+        chats[chat_id].append({"role": role, "content": content})
+        last_ts[chat_id] = ts
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            "INSERT OR IGNORE INTO chat_state(chat_id, history, ts) VALUES (?,?,?)",
+            [(c, orjson.dumps(h[-HISTORY_TURNS:]), last_ts[c]) for c, h in chats.items()],
+        )
+        conn.execute("DROP TABLE messages;")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+def _init_pins_fts(conn: sqlite3.Connection) -> None:
+    # Trigram FTS5 index over pins so /recall substring search doesn't scan every pin.
+    # Needs SQLite >= 3.34 built with FTS5; otherwise recall_pins keeps using LIKE.
+    global _PINS_FTS
+    try:
+        fresh = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='pins_fts'"
+        ).fetchone() is None
         conn.execute("""
-            CREATE INDEX IF NOT EXISTS idx_pins_chat_ts
-            ON pins(chat_id, ts);
+            CREATE VIRTUAL TABLE IF NOT EXISTS pins_fts
+            USING fts5(content, content='pins', content_rowid='id', tokenize='trigram');
         """)
+    except sqlite3.OperationalError:
+        log.warning("SQLite has no FTS5 trigram tokenizer; /recall falls back to LIKE")
+        return
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS pins_ai AFTER INSERT ON pins BEGIN
+            INSERT INTO pins_fts(rowid, content) VALUES (new.id, new.content);
+        END;
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS pins_ad AFTER DELETE ON pins BEGIN
+            INSERT INTO pins_fts(pins_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END;
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS pins_au AFTER UPDATE ON pins BEGIN
+            INSERT INTO pins_fts(pins_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO pins_fts(rowid, content) VALUES (new.id, new.content);
+        END;
+    """)
+    if fresh:
+        # Index pins saved before the FTS table existed.
+        conn.execute("INSERT INTO pins_fts(pins_fts) VALUES ('rebuild');")
+    _PINS_FTS = True
+
+SAVE_HISTORY_SQL = """
+    INSERT INTO chat_state(chat_id, history, ts) VALUES (?,?,?)
+    ON CONFLICT(chat_id) DO UPDATE SET history=excluded.history, ts=excluded.ts
+"""
+
+# In-process copy of each active chat's history window and recent pins, kept in step
+# with every write so the per-turn reads never touch SQLite. Chats are hydrated from
+# the DB on first use and evicted LRU. Only touched from the event-loop thread.
+_CHAT_CACHE: "OrderedDict[int, Tuple[Deque[Dict[str, str]], Deque[str]]]" = OrderedDict()
+
+def _hydrate_chat(chat_id: int) -> Tuple[Deque[Dict[str, str]], Deque[str]]:
+    # Caller has already waited for pending writes.
+    history, pins = load_chat_context(chat_id, pin_limit=RECENT_PINS)
+    entry = (deque(history, maxlen=HISTORY_TURNS), deque(pins, maxlen=RECENT_PINS))
+    _CHAT_CACHE[chat_id] = entry
+    while len(_CHAT_CACHE) > CACHE_CHATS:
+        # Never evict a chat mid-turn: its handler relies on the entry staying put.
+        victim = next((c for c in _CHAT_CACHE if c not in _CHAT_LOCKS), None)
+        if victim is None:
+            break
+        del _CHAT_CACHE[victim]
+    return entry
+
+def _cached_chat(chat_id: int) -> Tuple[Deque[Dict[str, str]], Deque[str]]:
+    entry = _CHAT_CACHE.get(chat_id)
+    if entry is not None:
+        _CHAT_CACHE.move_to_end(chat_id)
+        return entry
+    # Handlers call load_chat() first, so this blocking fallback stays off the loop.
+    _flush_writes()
+    return _hydrate_chat(chat_id)
+
+async def load_chat(chat_id: int) -> None:
+    """Make sure the chat's context is cached, waiting for pending writes off-loop."""
+    if chat_id in _CHAT_CACHE:
+        return
+    await wait_for_writes()
+    if chat_id not in _CHAT_CACHE:
+        _hydrate_chat(chat_id)
 
 def add_message(chat_id: int, role: str, content: str) -> None:
-    now = int(time.time())
-    with db() as conn:
-        conn.execute(
-            "INSERT INTO messages(chat_id, role, content, ts) VALUES (?,?,?,?)",
-            (chat_id, role, content, now),
-        )
-        # Trim history
-        cur = conn.execute(
-            "SELECT id FROM messages WHERE chat_id=? ORDER BY ts DESC, id DESC LIMIT ?",
-            (chat_id, HISTORY_TURNS),
-        )
-        keep_ids = {row[0] for row in cur.fetchall()}
-        conn.execute(
-            "DELETE FROM messages WHERE chat_id=? AND id NOT IN ({})".format(
-                ",".join(["?"] * len(keep_ids)) if keep_ids else "NULL"
-            ),
-            (chat_id, *keep_ids) if keep_ids else (chat_id,),
-        )
+    # The blob is rewritten whole, so the chat's window must be loaded first; the
+    # deque's maxlen does the trimming.
+    history = _cached_chat(chat_id)[0]
+    history.append({"role": role, "content": content})
+    _enqueue_write((SAVE_HISTORY_SQL, (chat_id, orjson.dumps(list(history)), _NOW)))
+
+CHAT_CONTEXT_SQL = """
+    SELECT 'h' AS k, history AS v, 0 AS s1, 0 AS s2 FROM chat_state WHERE chat_id=?
+    UNION ALL
+    SELECT 'p', content, -ts, -id FROM (
+        SELECT id, content, ts FROM pins WHERE chat_id=? ORDER BY ts DESC LIMIT ?
+    )
+    ORDER BY k, s1, s2
+"""
 
-def get_history(chat_id: int) -> List[Dict[str, str]]:
-    with db() as conn:
-        cur = conn.execute(
-            "SELECT role, content FROM messages WHERE chat_id=? ORDER BY ts ASC, id ASC",
-            (chat_id,),
-        )
-        return [{"role": r, "content": c} for (r, c) in cur.fetchall()]
+def load_chat_context(chat_id: int, pin_limit: int = RECENT_PINS) -> Tuple[List[Dict[str, str]], List[str]]:
+    """History (oldest first) and the most recent pins (newest first) in one query."""
+    history: List[Dict[str, str]] = []
+    pins: List[str] = []
+    for k, v, _s1, _s2 in db().execute(CHAT_CONTEXT_SQL, (chat_id, chat_id, pin_limit)):
+        if k == "h":
+            history = orjson.loads(v)
+        else:
+            pins.append(v)
+    return history, pins
+
+def get_chat_context(chat_id: int) -> Tuple[List[Dict[str, str]], List[str]]:
+    """Same as load_chat_context, served from the in-process cache."""
+    history, pins = _cached_chat(chat_id)
+    return list(history), list(pins)
 
 def clear_history(chat_id: int) -> None:
-    with db() as conn:
-        conn.execute("DELETE FROM messages WHERE chat_id=?", (chat_id,))
+    _enqueue_write(("DELETE FROM chat_state WHERE chat_id=?", (chat_id,)))
+    entry = _CHAT_CACHE.get(chat_id)
+    if entry is not None:
+        entry[0].clear()
 
 def add_pin(chat_id: int, content: str) -> None:
-    now = int(time.time())
-    with db() as conn:
-        conn.execute(
-            "INSERT INTO pins(chat_id, content, ts) VALUES (?,?,?)",
-            (chat_id, content, now),
-        )
+    _enqueue_write(
+        ("INSERT INTO pins(chat_id, content, ts) VALUES (?,?,?)", (chat_id, content, _NOW)),
+    )
+    entry = _CHAT_CACHE.get(chat_id)
+    if entry is not None:
+        entry[1].appendleft(content)
 
 def recall_pins(chat_id: int, query: str, limit: int = 10) -> List[Tuple[int, str]]:
-    q = f"%{query.strip()}%"
-    with db() as conn:
-        cur = conn.execute(
-            "SELECT id, content FROM pins WHERE chat_id=? AND content LIKE ? ORDER BY ts DESC LIMIT ?",
-            (chat_id, q, limit),
+    # `query` arrives stripped from cmd_recall, after wait_for_writes().
+    # Trigrams can't match queries shorter than 3 characters; those still scan with LIKE.
+    if _PINS_FTS and len(query) >= 3:
+        cur = db().execute(
+            "SELECT p.id, p.content FROM pins_fts f JOIN pins p ON p.id = f.rowid "
+            "WHERE pins_fts MATCH ? AND p.chat_id=? ORDER BY p.ts DESC LIMIT ?",
+            ('"' + query.replace('"', '""') + '"', chat_id, limit),
         )
-        return [(row[0], row[1]) for row in cur.fetchall()]
-
-def get_recent_pins(chat_id: int, limit: int = 5) -> List[str]:
-    with db() as conn:
-        cur = conn.execute(
-            "SELECT content FROM pins WHERE chat_id=? ORDER BY ts DESC LIMIT ?",
-            (chat_id, limit),
+    else:
+        cur = db().execute(
+            "SELECT id, content FROM pins WHERE chat_id=? AND content LIKE '%' || ? || '%' "
+            "ORDER BY ts DESC LIMIT ?",
+            (chat_id, query, limit),
         )
-        return [row[0] for row in cur.fetchall()]
+    return [(row[0], row[1]) for row in cur.fetchall()]
 
 
 # =========================
@@ -138,17 +387,30 @@ Rules:
 - Do NOT claim you have real feelings or consciousness.
 """
 
+# Shared async client: keep-alive connections to the provider are reused across
+# turns, and awaiting the call keeps the event loop free while the model generates.
+CLIENT = httpx.AsyncClient(
+    headers={"Authorization": f"Bearer {LLM_API_KEY}", "Content-Type": "application/json"},
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30.0),
+    timeout=LLM_TIMEOUT_SEC,
+    transport=httpx.AsyncHTTPTransport(retries=2),  # connect errors only
+)
+
+# prompt_cache_key is an OpenAI extension; other "compatible" providers may reject it.
+USE_PROMPT_CACHE_KEY = LLM_PROMPT_CACHE in ("1", "true", "yes") or (
+    LLM_PROMPT_CACHE == "auto" and httpx.URL(LLM_BASE_URL).host == "api.openai.com"
+)
+
 def build_messages(chat_id: int, user_text: str) -> List[Dict[str, str]]:
-    history = get_history(chat_id)
-    pins = get_recent_pins(chat_id, limit=5)
+    history, pins = get_chat_context(chat_id)
 
     context_block = ""
     if pins:
         context_block = "Pinned notes (high priority context):\n- " + "\n- ".join(pins)
 
-    msgs: List[Dict[str, str]] = [{"role": "system", "content": SYSTEM_PROMPT}]
-    if context_block:
-        msgs.append({"role": "system", "content": context_block})
+    # One deterministic system message, so the stable prefix can be cached provider-side.
+    system = SYSTEM_PROMPT + "\n" + context_block if context_block else SYSTEM_PROMPT
+    msgs: List[Dict[str, str]] = [{"role": "system", "content": system}]
 
     # Append chat history
     msgs.extend(history)
@@ -157,28 +419,82 @@ def build_messages(chat_id: int, user_text: str) -> List[Dict[str, str]]:
     msgs.append({"role": "user", "content": user_text})
     return msgs
 
-def call_llm(messages: List[Dict[str, str]]) -> str:
-    # OpenAI-compatible Chat Completions payload
-    payload = {
-        "model": LLM_MODEL,
-        "messages": messages,
-        "temperature": 0.4,
-    }
-    headers = {
-        "Authorization": f"Bearer {LLM_API_KEY}",
-        "Content-Type": "application/json",
-    }
-    resp = requests.post(LLM_BASE_URL, json=payload, headers=headers, timeout=LLM_TIMEOUT_SEC)
-    resp.raise_for_status()
-    data = resp.json()
-
+def _extract_content(data: Any) -> str:
     # Typical shape: { choices: [ { message: { content: "..." } } ] }
     try:
-        return data["choices"][0]["message"]["content"].strip()
+        return data["choices"][0]["message"]["content"]
     except Exception:
         # Fallback: show raw if provider differs
         return str(data)
 
+def _parse_sse_delta(line: str) -> Optional[str]:
+    # Stream frames look like: data: { choices: [ { delta: { content: "..." } } ] }
+    if not line.startswith("data:"):
+        return None
+    data = line[5:].strip()
+    if not data or data == "[DONE]":
+        return None
+    try:
+        frame = orjson.loads(data)
+    except ValueError:
+        return None
+    if not isinstance(frame, dict) or "error" in frame or "choices" not in frame:
+        # Provider reported a failure mid-stream: surface it instead of an empty reply.
+        raise RuntimeError(f"LLM stream error: {frame}")
+    try:
+        return frame["choices"][0]["delta"].get("content")
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return None  # role-only / finish / usage frames
+
+async def _stream_once(body: bytes) -> AsyncIterator[str]:
+    async with CLIENT.stream("POST", LLM_BASE_URL, content=body, timeout=LLM_TIMEOUT_SEC) as resp:
+        resp.raise_for_status()
+        if not resp.headers.get("content-type", "").startswith("text/event-stream"):
+            # Provider ignored "stream": treat it as a regular completion.
+            await resp.aread()
+            yield _extract_content(orjson.loads(resp.content))
+            return
+        async for line in resp.aiter_lines():
+            delta = _parse_sse_delta(line)
+            if delta:
+                yield delta
+
+async def stream_llm(messages: List[Dict[str, str]]) -> AsyncIterator[str]:
+    """Yield reply text chunks as the provider generates them."""
+    # OpenAI-compatible Chat Completions payload
+    payload = {
+        "model": LLM_MODEL,
+        "messages": messages,
+        "temperature": 0.4,
+        "stream": True,
+    }
+    if USE_PROMPT_CACHE_KEY:
+        # Routes turns sharing the same system prefix to the same prompt cache.
+        payload["prompt_cache_key"] = hashlib.sha1(messages[0]["content"].encode()).hexdigest()
+    body = orjson.dumps(payload)
+    # Provider latency has a long tail: if the first chunk takes longer than
+    # LLM_RETRY_TIMEOUT_SEC (or the request fails with 5xx), retry once instead of
+    # waiting out a stuck request. Once text is flowing, only LLM_TIMEOUT_SEC applies.
+    for first_chunk_timeout in (LLM_RETRY_TIMEOUT_SEC, None):
+        chunks = _stream_once(body)
+        try:
+            first = await asyncio.wait_for(anext(chunks), first_chunk_timeout)
+        except StopAsyncIteration:
+            return
+        except (asyncio.TimeoutError, httpx.TimeoutException, httpx.HTTPStatusError) as e:
+            await chunks.aclose()
+            if first_chunk_timeout is None:
+                raise
+            if isinstance(e, httpx.HTTPStatusError) and e.response.status_code < 500:
+                raise
+            continue
+        try:
+            yield first
+            async for delta in chunks:
+                yield delta
+        finally:
+            await chunks.aclose()
+        return
 
 # =========================
 # Telegram handlers
@@ -192,45 +508,105 @@ HELP_TEXT = (
     "Just send a message and I’ll reply in English + Russian."
 )
 
+class TokenBucket:
+    """Async token bucket: allows `burst` calls at once, refilled at `rate` per second."""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+# Keep outbound Bot API calls under Telegram's ~30 msg/s bot-wide limit, so bursts
+# queue here briefly instead of hitting 429 flood-control waits.
+TG_BUCKET = TokenBucket(rate=TG_RATE_PER_SEC, burst=max(1, int(TG_RATE_PER_SEC)))
+
+async def throttled(call: Callable[..., Awaitable[T]], *args: Any, **kwargs: Any) -> T:
+    await TG_BUCKET.acquire()
+    return await call(*args, **kwargs)
+
+class _ChatLock:
+    __slots__ = ("lock", "users")
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.users = 0  # holder + waiters
+
+# Updates are handled concurrently (see main); these keep each chat's turns in FIFO order.
+# Only chats with a turn in flight have an entry.
+_CHAT_LOCKS: Dict[int, _ChatLock] = {}
+
+@asynccontextmanager
+async def chat_turn(chat_id: int) -> AsyncIterator[None]:
+    entry = _CHAT_LOCKS.get(chat_id)
+    if entry is None:
+        entry = _CHAT_LOCKS[chat_id] = _ChatLock()
+    entry.users += 1
+    try:
+        async with entry.lock:
+            yield
+    finally:
+        entry.users -= 1
+        if not entry.users:
+            del _CHAT_LOCKS[chat_id]
+
+PIN_RE = re.compile(r"^/pin\s+(.+)$", re.DOTALL)
+RECALL_RE = re.compile(r"^/recall\s+(.+)$", re.DOTALL)
+
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await update.message.reply_text("Hi — I’m Atlas in Telegram.\n\n" + HELP_TEXT)
+    await throttled(update.message.reply_text, "Hi — I’m Atlas in Telegram.\n\n" + HELP_TEXT)
 
 async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await update.message.reply_text(HELP_TEXT)
+    await throttled(update.message.reply_text, HELP_TEXT)
 
 async def cmd_new(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
-    clear_history(chat_id)
-    await update.message.reply_text("✅ Reset done. (English + Russian replies will continue.)")
+    async with chat_turn(chat_id):
+        clear_history(chat_id)
+    await throttled(update.message.reply_text, "✅ Reset done. (English + Russian replies will continue.)")
 
 async def cmd_pin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
     text = update.message.text or ""
-    m = re.match(r"^/pin\s+(.+)$", text, flags=re.DOTALL)
+    m = PIN_RE.match(text)
     if not m:
-        await update.message.reply_text("Usage: /pin <text to remember>")
+        await throttled(update.message.reply_text, "Usage: /pin <text to remember>")
         return
     note = m.group(1).strip()
     if len(note) < 2:
-        await update.message.reply_text("Note is too short. Try again.")
+        await throttled(update.message.reply_text, "Note is too short. Try again.")
         return
-    add_pin(chat_id, note)
-    await update.message.reply_text("📌 Saved.")
+    async with chat_turn(chat_id):
+        add_pin(chat_id, note)
+    await throttled(update.message.reply_text, "📌 Saved.")
 
 async def cmd_recall(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
     text = update.message.text or ""
-    m = re.match(r"^/recall\s+(.+)$", text, flags=re.DOTALL)
+    m = RECALL_RE.match(text)
     if not m:
-        await update.message.reply_text("Usage: /recall <keyword>")
+        await throttled(update.message.reply_text, "Usage: /recall <keyword>")
         return
     q = m.group(1).strip()
+    await wait_for_writes()
     results = recall_pins(chat_id, q, limit=10)
     if not results:
-        await update.message.reply_text("No matches found.")
+        await throttled(update.message.reply_text, "No matches found.")
         return
     lines = [f"- {content}" for (_id, content) in results]
-    await update.message.reply_text("Matches:\n" + "\n".join(lines))
+    await throttled(update.message.reply_text, "Matches:\n" + "\n".join(lines))
 
 async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.message or not update.message.text:
@@ -239,36 +615,104 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     chat_id = update.effective_chat.id
     user_text = update.message.text.strip()
 
-    # Show "typing..."
-    await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-
-    # Store user msg
-    add_message(chat_id, "user", user_text)
-
-    # Build + call LLM
-    try:
-        msgs = build_messages(chat_id, user_text)
-        assistant_text = call_llm(msgs)
-    except Exception as e:
-        assistant_text = (
-            "English:\n"
-            "I hit an error calling the AI API. Check LLM_BASE_URL / LLM_API_KEY / model.\n"
-            f"Error: {e}\n\n"
-            "Russian:\n"
-            "Произошла ошибка при вызове AI API. Проверьте LLM_BASE_URL / LLM_API_KEY / модель.\n"
-            f"Ошибка: {e}"
+    # One turn at a time per chat keeps its history in order; other chats run concurrently.
+    async with chat_turn(chat_id):
+        # Show "typing..." without waiting for it: the round-trip overlaps the LLM request.
+        context.application.create_task(
+            throttled(context.bot.send_chat_action, chat_id=chat_id, action=ChatAction.TYPING),
+            update=update,
         )
 
-    # Store assistant msg
-    add_message(chat_id, "assistant", assistant_text)
+        # Store user msg
+        await load_chat(chat_id)
+        add_message(chat_id, "user", user_text)
+
+        # Build + call LLM, editing one Telegram message as the reply streams in
+        reply: Optional[Message] = None
+        shown = ""
+        # Groups are capped at ~20 messages/min (edits included), so they get a slower rate.
+        if update.effective_chat.type == ChatType.PRIVATE:
+            edit_sec = LLM_STREAM_EDIT_SEC
+        else:
+            edit_sec = LLM_STREAM_EDIT_SEC_GROUP
+        live = edit_sec > 0
+        send_error: Optional[TelegramError] = None
+        last_edit = 0.0
+        parts: List[str] = []
+        try:
+            msgs = build_messages(chat_id, user_text)
+            async for delta in stream_llm(msgs):
+                parts.append(delta)
+                if not live or time.monotonic() - last_edit < edit_sec:
+                    continue
+                partial = "".join(parts).strip()
+                if not partial or partial == shown:
+                    continue
+                try:
+                    if reply is None:
+                        reply = await throttled(update.message.reply_text, partial)
+                    else:
+                        await throttled(reply.edit_text, partial)
+                except TelegramError as e:
+                    send_error = e  # e.g. flood control: stop editing, send the final text
+                    live = False
+                    continue
+                shown = partial
+                last_edit = time.monotonic()
+            assistant_text = "".join(parts).strip()
+            if not assistant_text:
+                raise RuntimeError("The AI API returned an empty reply.")
+        except Exception as e:
+            assistant_text = (
+                "English:\n"
+                "I hit an error calling the AI API. Check LLM_BASE_URL / LLM_API_KEY / model.\n"
+                f"Error: {e}\n\n"
+                "Russian:\n"
+                "Произошла ошибка при вызове AI API. Проверьте LLM_BASE_URL / LLM_API_KEY / модель.\n"
+                f"Ошибка: {e}"
+            )
+
+        # Store assistant msg
+        add_message(chat_id, "assistant", assistant_text)
+
+        # Reply
+        if isinstance(send_error, RetryAfter):
+            await asyncio.sleep(send_error.retry_after)
+        if reply is not None and assistant_text != shown:
+            try:
+                await throttled(reply.edit_text, assistant_text)
+            except TelegramError as e:
+                # Don't leave the user with a truncated partial: send the full text fresh.
+                if isinstance(e, RetryAfter):
+                    await asyncio.sleep(e.retry_after)
+                reply = None
+        if reply is None:
+            await throttled(update.message.reply_text, assistant_text)
+
+
+async def on_startup(app: Application) -> None:
+    # Pre-warm: open a keep-alive connection to the LLM host so the first user message
+    # doesn't pay the TCP+TLS handshake. Any response (even 404) is good enough.
+    try:
+        await CLIENT.head(httpx.URL(LLM_BASE_URL).copy_with(path="/", query=None), timeout=5)
+    except httpx.HTTPError:
+        pass
 
-    # Reply
-    await update.message.reply_text(assistant_text)
+async def on_shutdown(app: Application) -> None:
+    await CLIENT.aclose()
+    close_db()
 
 
 def main() -> None:
     init_db()
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(True)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("help", cmd_help))